@@ -7,75 +7,247 @@ python-openid FileStore code is Copyright JanRain, under the Apache Software
 License.
 
 """
+import asyncio
+import base64
+import contextlib
+import functools
+import hashlib
 import logging
+import re
 import string
+import threading
 import time
 
-from openid import cryptutil
-from openid import oidutil
 from openid.association import Association
 from openid.store import nonce
 from openid.store.interface import OpenIDStore
 
 import redis
+import redis.asyncio
 
-__all__ = ['RedisStore']
+__all__ = ['AsyncRedisStore', 'BatchResult', 'RedisStore']
 
 _filename_allowed = string.ascii_letters + string.digits + '.'
-_isFilenameSafe = set(_filename_allowed).__contains__
+# str.translate table mapping every unsafe byte value to its escape, safe
+# characters are left out so translate keeps them as they are
+_filename_escapes = dict((i, '_%02X' % i) for i in range(256)
+                         if chr(i) not in _filename_allowed)
+# Digests that key names can be derived with, the keys only need to be
+# unique so a faster hash than SHA1 will do when changing key shapes is fine
+_hashes = {
+    'sha1': hashlib.sha1,
+    'blake2b': functools.partial(hashlib.blake2b, digest_size=16),
+}
+
+# The issued line of a serialized association, enough to pick the most
+# recently issued one without deserializing them all
+_issued_re = re.compile(rb'^issued:(\d+)$', re.M)
+
+# Fetches the associations listed in an index SET, pruning the entries
+# whose key has expired, so it takes a single round-trip with no follow-up.
+# The association keys can't be known beforehand, so the script reads keys
+# it is not given in KEYS: it needs them on the same node as the index and
+# it won't run on Redis Cluster or under ACLs limited to declared keys.
+_index_values_script = """
+local values = {}
+for _, key in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local value = redis.call('GET', key)
+    if value then
+        values[#values + 1] = value
+    else
+        redis.call('SREM', KEYS[1], key)
+    end
+end
+return values
+"""
+
+# The characters SCAN MATCH patterns give a meaning to
+_glob_special_re = re.compile(rb'([*?\[\]\\])')
+
+# The proto-domain-url_hash-handle_hash tail of an association key, after
+# key_prefix and its dash
+_association_tail_re = re.compile(
+    rb'[A-Za-z0-9+.]+-[A-Za-z0-9._]*-[A-Za-z0-9_.]+-[A-Za-z0-9_.]+')
+
+# Key safe base64 alphabet, '=' padding is stripped off the end
+_b64_translation = bytes.maketrans(b'+/', b'_.')
 
 log = logging.getLogger(__name__)
 
-def _safe64(s):
-    h64 = oidutil.toBase64(cryptutil.sha1(s))
-    h64 = h64.replace('+', '_')
-    h64 = h64.replace('/', '.')
-    h64 = h64.replace('=', '')
-    return h64
+# Connection pools shared by the stores created with the same settings
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _safe64(s, hash_algo='sha1'):
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    h64 = base64.b64encode(_hashes[hash_algo](s).digest())
+    return h64.translate(_b64_translation).rstrip(b'=')
 
 def _filenameEscape(s):
-    filename_chunks = []
-    for c in s:
-        if _isFilenameSafe(c):
-            filename_chunks.append(c)
-        else:
-            filename_chunks.append('_%02X' % ord(c))
-    return ''.join(filename_chunks)
+    # Non-ASCII text is escaped byte by byte in its UTF-8 form, the same
+    # way the byte strings of Python 2 were
+    if not s.isascii():
+        s = s.encode('utf-8').decode('latin-1')
+    return s.translate(_filename_escapes)
 
+@functools.lru_cache(maxsize=1024)
+def _server_url_parts(server_url, hash_algo):
+    # The (proto, domain, url_hash) bytes of a server_url used in its key
+    # names, a deployment only talks to a handful of servers so these are
+    # cached
+    if server_url:
+        proto, rest = server_url.split('://', 1)
+    else:
+        # Create empty proto / rest values for empty server_url,
+        # which is part of a consumer-generated nonce.
+        proto, rest = '', ''
+    return (proto.encode('utf-8'),
+            _filenameEscape(rest.split('/', 1)[0]).encode('ascii'),
+            _safe64(server_url, hash_algo))
+
+# Consumer-generated nonces come with an empty server_url, its parts are
+# the same constants every time
+_empty_url_parts = dict((hash_algo, _server_url_parts('', hash_algo))
+                        for hash_algo in _hashes)
+
+@functools.lru_cache(maxsize=1024)
+def _association_prefix(key_prefix, server_url, hash_algo):
+    # The key_prefix-proto-domain-url_hash- head shared by the association
+    # keys and the index SET of a server_url
+    if isinstance(server_url, bytes):
+        server_url = server_url.decode('utf-8')
+    if server_url.find('://') == -1:
+        raise ValueError('Bad server URL: %r' % server_url)
+    proto, domain, url_hash = _server_url_parts(server_url, hash_algo)
+    return b'-'.join((key_prefix, proto, domain, url_hash, b''))
+
+@functools.lru_cache(maxsize=1024)
+def _association_key(key_prefix, server_url, handle, hash_algo):
+    # The whole key name of an association in one cached call, so hashing
+    # and escaping only run the first time a server_url and handle are seen
+    prefix = _association_prefix(key_prefix, server_url, hash_algo)
+    if handle:
+        return prefix + _safe64(handle, hash_algo)
+    return prefix
+
+def _issued(association_s):
+    # The issued time of a serialized association, clients made with
+    # decode_responses=True reply with str rather than bytes
+    if isinstance(association_s, str):
+        association_s = association_s.encode('utf-8')
+    return int(_issued_re.search(association_s).group(1))
+
+def _queue_script(pipe, script, *keys):
+    # What calling a registered script does with a pipeline, the pipeline
+    # loads the script if Redis does not know it before its EVALSHA is sent.
+    # This works for redis.asyncio pipelines too, whose scripts are called
+    # as coroutines.
+    pipe.scripts.add(script)
+    pipe.evalsha(script.sha, len(keys), *keys)
+
+def _connection_pool(host, port, db, password, unix_socket):
+    # Stores are often created per request, sharing the pool saves a new
+    # connection (and socket) for each of them
+    pool_key = (host, port, db, password, unix_socket)
+    pool = _pools.get(pool_key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(pool_key)
+            if pool is None:
+                if unix_socket:
+                    pool = redis.ConnectionPool(
+                        connection_class=redis.UnixDomainSocketConnection,
+                        path=unix_socket, db=db, password=password)
+                else:
+                    pool = redis.ConnectionPool(host=host, port=port, db=db,
+                                                password=password)
+                _pools[pool_key] = pool
+    return pool
+
+
+class BatchResult(object):
+    """Result of a RedisStore call made inside RedisStore.batch()
+
+    The value is available once the batch has been sent, when the with
+    block exits. If sending the batch failed, reading it raises the error
+    the batch raised.
+
+    """
+    def __init__(self, finish, start, end):
+        self._finish = finish
+        self._start = start
+        self._end = end
+        self._resolved = False
+        self._value = None
+        self._error = None
+
+    def _resolve(self, replies):
+        self._value = self._finish(replies[self._start:self._end])
+        self._resolved = True
+
+    def _fail(self, error):
+        self._error = error
+
+    @property
+    def value(self):
+        if self._error is not None:
+            raise self._error
+        if not self._resolved:
+            raise RuntimeError('The batch has not been sent yet')
+        return self._value
+
+
+class _BaseRedisStore(OpenIDStore):
+    """The store methods shared by RedisStore and AsyncRedisStore
+
+    Each method queues its commands and parses their replies through
+    _run, which the subclasses implement for their client.
+
+    """
+    # Client class wrapping the connection pools
+    _client_class = None
 
-class RedisStore(OpenIDStore):
-    """Implementation of OpenIDStore for Redis"""
     def __init__(self, host='localhost', port=6379, db=0,
             key_prefix='oid_redis', conn=None, unix_socket=None,
-            password=None):
+            password=None, hash_algo='sha1', connection_pool=None):
+        if hash_algo not in _hashes:
+            raise ValueError('Unknown hash_algo: %r' % hash_algo)
+        if conn is None and connection_pool is not None:
+            conn = self._client_class(connection_pool=connection_pool)
         if conn is not None:
             self._conn = conn
-            try:
-                self.host = self._conn.connection_pool.connection_kwargs['host']
-                self.port = self._conn.connection_pool.connection_kwargs['port']
-                self.unix_socket = None
-            except KeyError:
+            # Pools made without some of these settings use the defaults
+            connection_kwargs = self._conn.connection_pool.connection_kwargs
+            if 'path' in connection_kwargs:
                 self.host = None
                 self.port = 0
-                self.unix_socket = self._conn.connection_pool.connection_kwargs['path']
-            self.db = self._conn.connection_pool.connection_kwargs['db']
-            self.password = self._conn.connection_pool.connection_kwargs['password']
+                self.unix_socket = connection_kwargs['path']
+            else:
+                self.host = connection_kwargs.get('host', 'localhost')
+                self.port = connection_kwargs.get('port', 6379)
+                self.unix_socket = None
+            self.db = connection_kwargs.get('db', 0)
+            self.password = connection_kwargs.get('password')
         else:
             self.unix_socket = unix_socket
             self.host = host
             self.port = port
             self.db = db
             self.password = password
-            redis_args = {'db': db, 'password': password}
-            if self.unix_socket:
-                redis_args['unix_socket_path'] = self.unix_socket
-            else:
-                redis_args['host'] = self.host
-                redis_args['port'] = self.port
-            self._conn = redis.Redis(**redis_args)
+            self._conn = self._connect(host, port, db, password, unix_socket)
         self.key_prefix = key_prefix
-        self.log_debug = logging.DEBUG >= log.getEffectiveLevel()
-    
+        self.hash_algo = hash_algo
+        # Key names are built as bytes, which redis-py sends as they are
+        self._key_prefix = key_prefix.encode('utf-8')
+        # Used nonces live in one sorted set, scored by their timestamp
+        self._nonce_key = self._key_prefix + b':nonces'
+        # The index SETs holding associations, for cleanupAssociations
+        self._indexes_key = self._key_prefix + b':indexes'
+        # Sent by its SHA1 digest, the pipeline loads it the first time
+        self._index_values = self._conn.register_script(_index_values_script)
+        self.log_debug = log.isEnabledFor(logging.DEBUG)
+
     def getAssociationFilename(self, server_url, handle):
         """Create a unique filename for a given server url and
         handle. This implementation does not assume anything about the
@@ -83,124 +255,406 @@ class RedisStore(OpenIDStore):
         contain the domain name from the server URL for ease of human
         inspection of the data directory.
 
-        (str, str) -> str
+        (str, str) -> bytes
         """
-        if server_url.find('://') == -1:
-            raise ValueError('Bad server URL: %r' % server_url)
-
-        proto, rest = server_url.split('://', 1)
-        domain = _filenameEscape(rest.split('/', 1)[0])
-        url_hash = _safe64(server_url)
-        if handle:
-            handle_hash = _safe64(handle)
-        else:
-            handle_hash = ''
-
-        filename = '%s-%s-%s-%s-%s' % (self.key_prefix, proto, domain, url_hash, handle_hash)
+        filename = _association_key(self._key_prefix, server_url, handle,
+                                    self.hash_algo)
         if self.log_debug:
             log.debug('Returning filename: %s', filename)
         return filename
 
+    def _index_key(self, server_url):
+        """Name of the Redis SET holding the association keys stored for
+        server_url, which saves scanning the keyspace for them"""
+        return _association_prefix(self._key_prefix, server_url,
+                                   self.hash_algo) + b':idx'
+
+    def _run_all(self, ops, combine):
+        """Run the (queue, finish) steps of ops in one round-trip and
+        return combine() of their results, in order"""
+        spans = []
+
+        def queue(pipe):
+            start = len(pipe)
+            for op_queue, _ in ops:
+                begin = len(pipe) - start
+                op_queue(pipe)
+                spans.append((begin, len(pipe) - start))
+
+        def finish(replies):
+            return combine([op_finish(replies[begin:end])
+                            for (_, op_finish), (begin, end)
+                            in zip(ops, spans)])
+
+        return self._run(queue, finish)
+
     def storeAssociation(self, server_url, association):
-        # Determine how long this association is good for
-        issued_offset = int(time.time()) - association.issued
-        seconds_from_now = issued_offset + association.lifetime
+        return self._run(*self._store_ops(server_url, association))
+
+    def storeAssociations(self, pairs):
+        """Store each (server_url, association) of pairs in one
+        round-trip, as storeAssociation does"""
+        ops = [self._store_ops(server_url, association)
+               for server_url, association in pairs]
+        return self._run_all(ops, lambda results: None)
+
+    def _store_ops(self, server_url, association):
+        """The queue and finish steps of storeAssociation"""
+        log_debug = self.log_debug
+
+        # Determine how long this association is good for, zero once it
+        # has expired
+        seconds_from_now = association.expiresIn
                 
         association_s = association.serialize()
         key_name = self.getAssociationFilename(server_url, association.handle)
-        
-        self._conn.set(key_name, association_s)
-        if self.log_debug:
-            log.debug('Storing key: %s', key_name)
-    
-        # By default, set the expiration from the assocation expiration
-        self._conn.expire(key_name, seconds_from_now)
-        if self.log_debug:
-            log.debug('Expiring: %s, in %s seconds', key_name, seconds_from_now)
-        return None
+        index_key = self._index_key(server_url)
+
+        def queue(pipe):
+            if seconds_from_now <= 0:
+                # Already expired, SET refuses a non-positive expire time
+                pipe.delete(key_name)
+                pipe.srem(index_key, key_name)
+                return
+
+            # Store the key and its expiration, taken from the association
+            # expiration, along with its index entry in one round-trip
+            pipe.set(key_name, association_s, ex=seconds_from_now)
+            pipe.sadd(index_key, key_name)
+            pipe.sadd(self._indexes_key, index_key)
+            if log_debug:
+                log.debug('Storing key: %s, expiring in %s seconds', key_name,
+                          seconds_from_now)
+
+        return queue, lambda replies: None
     
     def getAssociation(self, server_url, handle=None):
+        return self._run(*self._association_ops(server_url, handle))
+
+    def getAssociations(self, server_url, handles):
+        """Get the associations of server_url for each of handles, in one
+        round-trip, as a dict keyed by handle. A handle of None gets the
+        most recently issued association, as getAssociation does."""
+        handles = list(handles)
+        ops = [self._association_ops(server_url, handle) for handle in handles]
+        return self._run_all(ops, lambda results: dict(zip(handles, results)))
+
+    def _association_ops(self, server_url, handle):
+        """The queue and finish steps of getAssociation"""
         log_debug = self.log_debug
         
         if log_debug:
             log.debug('Association requested for server_url: %s, with handle: %s', server_url, handle)
         
         if handle is None:
-            # Retrieve all the keys for this server connection
-            key_name = self.getAssociationFilename(server_url, '')
-            assocs = self._conn.keys('%s*' % key_name)
-            
-            if not assocs:
+            index_key = self._index_key(server_url)
+
+            def queue(pipe):
+                # Fetch every association in the index in one command,
+                # index entries whose key has expired are pruned on the way
+                _queue_script(pipe, self._index_values, index_key)
+
+            def finish(replies):
+                # Now use the one that was issued most recently, only that
+                # one gets deserialized
+                issued = max(((_issued(assoc), assoc) for assoc in replies[0]),
+                             key=lambda pair: pair[0], default=None)
+                if issued is None:
+                    if log_debug:
+                        log.debug('No association found for: %s', server_url)
+                    return None
                 if log_debug:
-                    log.debug('No association found for: %s', server_url)
-                return None
-            
-            # Now use the one that was issued most recently
-            associations = []
-            for assoc in self._conn.mget(assocs):
-                associations.append(Association.deserialize(assoc))
-            associations.sort(cmp=lambda x,y: cmp(x.issued, y.issued))
-            if log_debug:
-                log.debug('getAssociation found, returns most recently issued')
-            return associations[-1]
+                    log.debug('getAssociation found, returns most recently issued')
+                return Association.deserialize(issued[1])
         else:
             key_name = self.getAssociationFilename(server_url, handle)
-            association_s = self._conn.get(key_name)
-            if association_s:
-                if log_debug:
-                    log.debug('getAssociation found, returning association')
-                return Association.deserialize(association_s)
-            else:
-                if log_debug:
-                    log.debug('No association found for getAssociation')
-                return None
+
+            def queue(pipe):
+                pipe.get(key_name)
+
+            def finish(replies):
+                association_s = replies[0]
+                if association_s:
+                    if log_debug:
+                        log.debug('getAssociation found, returning association')
+                    return Association.deserialize(association_s)
+                else:
+                    if log_debug:
+                        log.debug('No association found for getAssociation')
+                    return None
+
+        return queue, finish
     
     def removeAssociation(self, server_url, handle):
         key_name = self.getAssociationFilename(server_url, handle)
+        index_key = self._index_key(server_url)
         if self.log_debug:
             log.debug('Removing association: %s', key_name)
-        return self._conn.delete(key_name)
+
+        def queue(pipe):
+            pipe.delete(key_name)
+            pipe.srem(index_key, key_name)
+
+        return self._run(queue, lambda replies: replies[0])
     
     def useNonce(self, server_url, timestamp, salt):
         log_debug = self.log_debug
         if abs(timestamp - time.time()) > nonce.SKEW:
             if log_debug:
                 log.debug('Timestamp from current time is less than skew')
-            return False
+            return self._run(None, lambda replies: False)
                 
         if server_url:
-            proto, rest = server_url.split('://', 1)
+            if isinstance(server_url, bytes):
+                server_url = server_url.decode('utf-8')
+            proto, domain, url_hash = _server_url_parts(server_url,
+                                                        self.hash_algo)
         else:
-            # Create empty proto / rest values for empty server_url,
-            # which is part of a consumer-generated nonce.
-            proto, rest = '', ''
-
-        domain = _filenameEscape(rest.split('/', 1)[0])
-        url_hash = _safe64(server_url)
-        salt_hash = _safe64(salt)
-
-        anonce = '%s-nonce-%08x-%s-%s-%s-%s' % (self.key_prefix, timestamp, proto, domain,
-                                         url_hash, salt_hash)
-        exists = self._conn.getset(anonce, '%s' % timestamp)
-        if exists:
-            if log_debug:
-                log.debug('Nonce already exists: %s', anonce)
-            return False
-        else:
-            if log_debug:
-                log.debug('Unused nonce, storing: %s', anonce)
-            # Let's set an expire time
-            curr_offset = time.time() - timestamp
-            self._conn.expire(anonce, int(curr_offset + nonce.SKEW))
-            return True
+            proto, domain, url_hash = _empty_url_parts[self.hash_algo]
+        salt_hash = _safe64(salt, self.hash_algo)
+
+        anonce = b'-'.join((b'%08x' % timestamp, proto, domain, url_hash,
+                            salt_hash))
+        # Versions before the nonce ZSET stored each nonce in a key of its
+        # own, those used within the skew still count as used
+        legacy_key = self._key_prefix + b'-nonce-' + anonce
+
+        def queue(pipe):
+            # Drop the nonces that are past the skew, the timestamp check
+            # above rejects them anyway, then add this one unless it is
+            # already there, in one round-trip
+            pipe.zremrangebyscore(self._nonce_key, '-inf',
+                                  time.time() - nonce.SKEW)
+            pipe.exists(legacy_key)
+            pipe.zadd(self._nonce_key, {anonce: timestamp}, nx=True)
+
+        def finish(replies):
+            if replies[1] or not replies[2]:
+                if log_debug:
+                    log.debug('Nonce already exists: %s', anonce)
+                return False
+            else:
+                if log_debug:
+                    log.debug('Unused nonce, stored: %s', anonce)
+                return True
+
+        return self._run(queue, finish)
     
     def cleanupNonces(self):
-        keys = self._conn.keys('%s-nonce-*' % self.key_prefix)
-        expired = 0
-        for key in keys:
-            # See if its expired
-            timestamp = int(self._conn.get(key))
-            if abs(timestamp - time.time()) > nonce.SKEW:
-                self._conn.delete(key)
-                expired += 1
-        return expired
+        def queue(pipe):
+            pipe.zremrangebyscore(self._nonce_key, '-inf',
+                                  time.time() - nonce.SKEW)
+
+        return self._run(queue, lambda replies: replies[0])
+
+    def cleanupAssociations(self, count=1000):
+        """Prune the index entries of the associations Redis has expired,
+        returning how many there were. The associations themselves expire
+        along with their keys.
+
+        The indexes are walked with SSCAN, count entries a round-trip, so
+        Redis is never blocked for long. This takes several round-trips,
+        so it is not part of a batch.
+
+        """
+        return self._run_steps(self._cleanup_steps(count))
+
+    def _cleanup_steps(self, count):
+        # The round-trips of cleanupAssociations, for _run_steps
+        indexes_key = self._indexes_key
+        pruned = 0
+        replies = yield lambda pipe: pipe.smembers(indexes_key)
+        for index_key in replies[0]:
+            cursor = 0
+            while True:
+                replies = yield lambda pipe: pipe.sscan(index_key, cursor,
+                                                        count=count)
+                cursor, members = replies[0]
+                if members:
+                    found = yield lambda pipe: [pipe.exists(key)
+                                                for key in members]
+                    stale = [key for key, exists in zip(members, found)
+                             if not exists]
+                    if stale:
+                        # An association stored again since its EXISTS
+                        # loses the entry, getAssociation by handle still
+                        # finds it
+                        replies = yield lambda pipe: pipe.srem(index_key,
+                                                               *stale)
+                        pruned += replies[0]
+                if not cursor:
+                    break
+            # Redis deletes a SET with its last member, the index is then
+            # dropped from the list
+            replies = yield lambda pipe: pipe.exists(index_key)
+            if not replies[0]:
+                yield lambda pipe: pipe.srem(indexes_key, index_key)
+        return pruned
+
+    def reindexAssociations(self, count=1000):
+        """Add the associations stored before the per-server index SETs
+        existed to their index, returning how many were added.
+
+        Run it once after upgrading; until then getAssociation without a
+        handle does not find those associations. It SCANs the keys under
+        key_prefix, count at a time, so it is not part of a batch.
+
+        """
+        return self._run_steps(self._reindex_steps(count))
+
+    def _reindex_steps(self, count):
+        # The round-trips of reindexAssociations, for _run_steps
+        pattern = _glob_special_re.sub(rb'\\\1', self._key_prefix) + b'-*'
+        tail_start = len(self._key_prefix) + 1
+        added = 0
+        cursor = 0
+        while True:
+            replies = yield lambda pipe: pipe.scan(cursor, match=pattern,
+                                                   count=count)
+            cursor, key_names = replies[0]
+            key_names = [key_name.encode('utf-8')
+                         if isinstance(key_name, str) else key_name
+                         for key_name in key_names]
+            # The pattern also matches the index SETs, the nonce keys of
+            # earlier versions and the keys of stores whose key_prefix
+            # starts with this one and a dash, none of them has this shape
+            key_names = [key_name for key_name in key_names
+                         if _association_tail_re.fullmatch(key_name,
+                                                           tail_start)]
+            if key_names:
+                def queue(pipe):
+                    for key_name in key_names:
+                        # The index of a key is named after its prefix, up
+                        # to the handle
+                        index_key = (key_name[:key_name.rindex(b'-') + 1] +
+                                     b':idx')
+                        pipe.sadd(index_key, key_name)
+                        pipe.sadd(self._indexes_key, index_key)
+
+                replies = yield queue
+                added += sum(replies[::2])
+            if not cursor:
+                return added
+
+
+class RedisStore(_BaseRedisStore):
+    """Implementation of OpenIDStore for Redis"""
+    _client_class = redis.Redis
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The pipeline and results of each thread's batch()
+        self._local = threading.local()
+
+    def _connect(self, host, port, db, password, unix_socket):
+        pool = _connection_pool(host, port, db, password, unix_socket)
+        return self._client_class(connection_pool=pool)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Queue the store calls made in the with block and send them to
+        Redis in one round-trip when the block exits.
+
+        Each call made in the block returns a BatchResult whose value is
+        set once the block exits. A batch nested in another one joins it.
+
+            with store.batch():
+                assoc = store.getAssociation(server_url, handle)
+                fresh = store.useNonce(server_url, timestamp, salt)
+            assoc.value, fresh.value
+
+        """
+        if getattr(self._local, 'batch', None) is not None:
+            yield
+            return
+        pipe = self._conn.pipeline(transaction=False)
+        results = []
+        self._local.batch = (pipe, results)
+        try:
+            yield
+            try:
+                replies = pipe.execute()
+            except Exception as error:
+                for result in results:
+                    result._fail(error)
+                raise
+        finally:
+            self._local.batch = None
+        for result in results:
+            result._resolve(replies)
+
+    def _run_steps(self, steps):
+        """Send each round-trip the steps generator yields a queue function
+        for in a pipeline of its own, sending the replies back into it, and
+        return what it returns. These are not part of a batch."""
+        replies = None
+        while True:
+            try:
+                queue = steps.send(replies)
+            except StopIteration as stop:
+                return stop.value
+            pipe = self._conn.pipeline(transaction=False)
+            queue(pipe)
+            replies = pipe.execute()
+
+    def _run(self, queue, finish):
+        """Send the commands queue(pipe) adds to a pipeline and return
+        finish(replies), or a BatchResult for it when inside batch()"""
+        batch = getattr(self._local, 'batch', None)
+        if batch is None:
+            if queue is None:
+                return finish([])
+            pipe = self._conn.pipeline(transaction=False)
+            queue(pipe)
+            return finish(pipe.execute())
+        pipe, results = batch
+        start = len(pipe)
+        if queue is not None:
+            queue(pipe)
+        result = BatchResult(finish, start, len(pipe))
+        results.append(result)
+        return result
+
+
+class AsyncRedisStore(_BaseRedisStore):
+    """OpenIDStore for asyncio applications, using redis.asyncio
+
+    It takes the same parameters as RedisStore. Every store method is a
+    coroutine and takes a single round-trip, so independent calls can run
+    concurrently with asyncio.gather, there is no batch(). The connection
+    is created for the store as asyncio connections are bound to the
+    event loop they are used on.
+
+    """
+    _client_class = redis.asyncio.Redis
+
+    def _connect(self, host, port, db, password, unix_socket):
+        if unix_socket:
+            return redis.asyncio.Redis(unix_socket_path=unix_socket, db=db,
+                                       password=password)
+        return redis.asyncio.Redis(host=host, port=port, db=db,
+                                   password=password)
+
+    async def _run(self, queue, finish):
+        if queue is None:
+            return finish([])
+        async with self._conn.pipeline(transaction=False) as pipe:
+            queue(pipe)
+            return finish(await pipe.execute())
+
+    async def cleanup(self):
+        """Run cleanupNonces and cleanupAssociations concurrently, returning
+        (nonces removed, associations pruned) as OpenIDStore.cleanup does"""
+        return tuple(await asyncio.gather(self.cleanupNonces(),
+                                          self.cleanupAssociations()))
+
+    async def _run_steps(self, steps):
+        replies = None
+        while True:
+            try:
+                queue = steps.send(replies)
+            except StopIteration as stop:
+                return stop.value
+            async with self._conn.pipeline(transaction=False) as pipe:
+                queue(pipe)
+                replies = await pipe.execute()
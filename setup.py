@@ -12,6 +12,7 @@ setup(name='openid-redis',
         "Development Status :: 6 - Mature",
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
+        "Programming Language :: Python :: 3",
         "Topic :: Internet :: WWW/HTTP"
       ],
       keywords='openid redis',
@@ -22,7 +23,8 @@ setup(name='openid-redis',
       packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
       include_package_data=True,
       zip_safe=False,
-      install_requires=["redis>=2.4.0", "python-openid>=2.2.5"],
+      python_requires=">=3.7",
+      install_requires=["redis>=4.2.0", "python3-openid>=3.0"],
       entry_points="""
       # -*- Entry points: -*-
       """,
@@ -7,37 +7,83 @@ Apache Software License
 
 """
 
+import asyncio
+import contextlib
+import itertools
+from functools import partial
 import unittest
 import string
 import time
 import socket
-import random
+import secrets
 import os
 
+import pytest
 import redis
-from nose.tools import raises
 from openid.association import Association
 from openid.cryptutil import randomString
+from openid.store import nonce as nonceModule
 from openid.store.nonce import mkNonce, split
 
-allowed_handle = []
-for c in string.printable:
-    if c not in string.whitespace:
-        allowed_handle.append(c)
-allowed_handle = ''.join(allowed_handle)
+allowed_handle = string.printable.translate(
+    str.maketrans('', '', string.whitespace))
 
 def generateHandle(n):
     return randomString(n, allowed_handle)
 
 generateSecret = randomString
 
+# Handles and secrets generated once and handed out in turn, a store check
+# needs fewer associations than there are in the pool so they stay distinct
+_handles = itertools.cycle([generateHandle(128) for _ in range(16)])
+_secrets = itertools.cycle([generateSecret(20) for _ in range(16)])
+
+_hostname = socket.gethostname().translate(str.maketrans('.-', '__'))
+
 def getTmpDbName():
-    hostname = socket.gethostname()
-    hostname = hostname.replace('.', '_')
-    hostname = hostname.replace('-', '_')
     return "%s_%d_%s_openid_test" % \
-           (hostname, os.getpid(), \
-            random.randrange(1, int(time.time())))
+           (_hostname, os.getpid(), secrets.token_hex(4))
+
+def _gen_assoc(now, issued, lifetime=600):
+    sec = next(_secrets)
+    hdl = next(_handles)
+    return Association(hdl, sec, now + issued, lifetime, 'HMAC-SHA1')
+
+def _check_retrieved(retrieved_assoc, expected):
+    assert retrieved_assoc == expected, (retrieved_assoc, expected)
+    if expected is not None:
+        if retrieved_assoc is expected:
+            print ('Unexpected: retrieved a reference to the expected '
+                   'value instead of a new object')
+        assert retrieved_assoc.handle == expected.handle
+        assert retrieved_assoc.secret == expected.secret
+
+def _check_retrieve(store, url, handle=None, expected=None):
+    _check_retrieved(store.getAssociation(url, handle), expected)
+
+def _check_retrieve_all(store, url, *checks):
+    # _check_retrieve each (handle, expected), in one getAssociations call
+    retrieved = store.getAssociations(url, [handle for handle, _ in checks])
+    for handle, expected in checks:
+        _check_retrieved(retrieved[handle], expected)
+
+def _check_remove(store, url, handle, expected):
+    present = store.removeAssociation(url, handle)
+    assert bool(expected) == bool(present)
+
+def _check_remove_all(store, *checks):
+    # _check_remove each (url, handle, expected), in one batch
+    with store.batch():
+        removed = [(store.removeAssociation(url, handle), expected)
+                   for url, handle, expected in checks]
+    for present, expected in removed:
+        assert bool(expected) == bool(present.value)
+
+def _check_use_nonce(store, nonce_parts, expected, server_url, msg=''):
+    stamp, salt = nonce_parts
+    actual = store.useNonce(server_url, stamp, salt)
+    assert bool(actual) == bool(expected), "%r != %r: %s" % (actual, expected,
+                                                             msg)
 
 def _store_check(store):
     """Make sure a given store has a minimum of API compliance. Call
@@ -48,30 +94,17 @@ def _store_check(store):
     OpenIDStore -> NoneType
     """
     ### Association functions
-    now = int(time.time())
+    now = time.time_ns() // 1_000_000_000
 
     server_url = 'http://www.myopenid.com/openid'
     horrid_server_url = u'http://Иasdfкwщо/opnid'.encode('utf-8')
     bad_server_url = 'http:www.openid.com/'
     
-    def genAssoc(issued, lifetime=600):
-        sec = generateSecret(20)
-        hdl = generateHandle(128)
-        return Association(hdl, sec, now + issued, lifetime, 'HMAC-SHA1')
-
-    def checkRetrieve(url, handle=None, expected=None):
-        retrieved_assoc = store.getAssociation(url, handle)
-        assert retrieved_assoc == expected, (retrieved_assoc, expected)
-        if expected is not None:
-            if retrieved_assoc is expected:
-                print ('Unexpected: retrieved a reference to the expected '
-                       'value instead of a new object')
-            assert retrieved_assoc.handle == expected.handle
-            assert retrieved_assoc.secret == expected.secret
-
-    def checkRemove(url, handle, expected):
-        present = store.removeAssociation(url, handle)
-        assert bool(expected) == bool(present)
+    genAssoc = partial(_gen_assoc, now)
+    checkRetrieve = partial(_check_retrieve, store)
+    checkRetrieveAll = partial(_check_retrieve_all, store)
+    checkRemove = partial(_check_remove, store)
+    checkRemoveAll = partial(_check_remove_all, store)
 
     assoc = genAssoc(issued=0)
 
@@ -87,10 +120,8 @@ def _store_check(store):
     checkRetrieve(horrid_server_url, None, assoc)
 
     # Check that storing a bad url doesn't work
-    @raises(ValueError)
-    def test_bad_url():
+    with pytest.raises(ValueError):
         store.storeAssociation(bad_server_url, assoc)
-    test_bad_url()
 
     # more than once
     checkRetrieve(server_url, None, assoc)
@@ -135,38 +166,42 @@ def _store_check(store):
     assoc3 = genAssoc(issued=2, lifetime=100)
     store.storeAssociation(server_url, assoc3)
 
-    checkRetrieve(server_url, None, assoc3)
-    checkRetrieve(server_url, assoc.handle, assoc)
-    checkRetrieve(server_url, assoc2.handle, assoc2)
-    checkRetrieve(server_url, assoc3.handle, assoc3)
+    checkRetrieveAll(server_url,
+                     (None, assoc3),
+                     (assoc.handle, assoc),
+                     (assoc2.handle, assoc2),
+                     (assoc3.handle, assoc3))
 
     checkRemove(server_url, assoc2.handle, True)
 
-    checkRetrieve(server_url, None, assoc3)
-    checkRetrieve(server_url, assoc.handle, assoc)
-    checkRetrieve(server_url, assoc2.handle, None)
-    checkRetrieve(server_url, assoc3.handle, assoc3)
+    checkRetrieveAll(server_url,
+                     (None, assoc3),
+                     (assoc.handle, assoc),
+                     (assoc2.handle, None),
+                     (assoc3.handle, assoc3))
 
-    checkRemove(server_url, assoc2.handle, False)
-    checkRemove(server_url, assoc3.handle, True)
+    checkRemoveAll((server_url, assoc2.handle, False),
+                   (server_url, assoc3.handle, True))
 
-    checkRetrieve(server_url, None, assoc)
-    checkRetrieve(server_url, assoc.handle, assoc)
-    checkRetrieve(server_url, assoc2.handle, None)
-    checkRetrieve(server_url, assoc3.handle, None)
+    checkRetrieveAll(server_url,
+                     (None, assoc),
+                     (assoc.handle, assoc),
+                     (assoc2.handle, None),
+                     (assoc3.handle, None))
 
-    checkRemove(server_url, assoc2.handle, False)
-    checkRemove(server_url, assoc.handle, True)
-    checkRemove(server_url, assoc3.handle, False)
+    checkRemoveAll((server_url, assoc2.handle, False),
+                   (server_url, assoc.handle, True),
+                   (server_url, assoc3.handle, False))
 
-    checkRetrieve(server_url, None, None)
-    checkRetrieve(server_url, assoc.handle, None)
-    checkRetrieve(server_url, assoc2.handle, None)
-    checkRetrieve(server_url, assoc3.handle, None)
+    checkRetrieveAll(server_url,
+                     (None, None),
+                     (assoc.handle, None),
+                     (assoc2.handle, None),
+                     (assoc3.handle, None))
 
-    checkRemove(server_url, assoc2.handle, False)
-    checkRemove(server_url, assoc.handle, False)
-    checkRemove(server_url, assoc3.handle, False)
+    checkRemoveAll((server_url, assoc2.handle, False),
+                   (server_url, assoc.handle, False),
+                   (server_url, assoc3.handle, False))
 
     ### test expired associations
     # assoc 1: server 1, valid
@@ -178,17 +213,32 @@ def _store_check(store):
     assocExpired1 = genAssoc(issued=-7200,lifetime=3600)
     assocExpired2 = genAssoc(issued=-7200,lifetime=3600)
 
+    store.storeAssociations([(server_url, assocValid1),
+                             (server_url, assocExpired1),
+                             (server_url + '1', assocExpired2),
+                             (server_url + '2', assocValid2)])
+
+    # The expired ones were never stored, so there is nothing to prune
+    assert store.cleanupAssociations() == 0
+
+    checkRetrieveAll(server_url,
+                     (None, assocValid1),
+                     (assocValid1.handle, assocValid1),
+                     (assocExpired1.handle, None))
+    checkRetrieveAll(server_url + '1',
+                     (None, None),
+                     (assocExpired2.handle, None))
+    checkRetrieveAll(server_url + '2',
+                     (None, assocValid2),
+                     (assocValid2.handle, assocValid2))
+
     ### Nonce functions
 
-    def checkUseNonce(nonce, expected, server_url, msg=''):
-        stamp, salt = split(nonce)
-        actual = store.useNonce(server_url, stamp, salt)
-        assert bool(actual) == bool(expected), "%r != %r: %s" % (actual, expected,
-                                                                 msg)
+    checkUseNonce = partial(_check_use_nonce, store)
 
-    for url in [server_url, '']:
+    for url in [server_url, '', horrid_server_url]:
         # Random nonce (not in store)
-        nonce1 = mkNonce()
+        nonce1 = split(mkNonce())
 
         # A nonce is allowed by default
         checkUseNonce(nonce1, True, url)
@@ -200,23 +250,25 @@ def _store_check(store):
 
         # Nonces from when the universe was an hour old should not pass these days.
         old_nonce = mkNonce(3600)
-        checkUseNonce(old_nonce, False, url, "Old nonce (%r) passed." % (old_nonce,))
+        checkUseNonce(split(old_nonce), False, url,
+                      "Old nonce (%r) passed." % (old_nonce,))
 
 
-    old_nonce1 = mkNonce(now - 20000)
-    old_nonce2 = mkNonce(now - 10000)
-    recent_nonce = mkNonce(now - 600)
+    # Split once, each of these is used twice
+    old_nonce1 = split(mkNonce(now - 20000))
+    old_nonce2 = split(mkNonce(now - 10000))
+    recent_nonce = split(mkNonce(now - 600))
 
-    from openid.store import nonce as nonceModule
     orig_skew = nonceModule.SKEW
     try:
         nonceModule.SKEW = 0
         store.cleanupNonces()
         # Set SKEW high so stores will keep our nonces.
         nonceModule.SKEW = 100000
-        assert store.useNonce(server_url, *split(old_nonce1))
-        assert store.useNonce(server_url, *split(old_nonce2))
-        assert store.useNonce(server_url, *split(recent_nonce))
+        with store.batch():
+            used = [store.useNonce(server_url, *n)
+                    for n in [old_nonce1, old_nonce2, recent_nonce]]
+        assert [u.value for u in used] == [True, True, True]
 
         nonceModule.SKEW = 3600
         cleaned = store.cleanupNonces()
@@ -225,33 +277,317 @@ def _store_check(store):
         nonceModule.SKEW = 100000
         # A roundabout method of checking that the old nonces were cleaned is
         # to see if we're allowed to add them again.
-        assert store.useNonce(server_url, *split(old_nonce1))
-        assert store.useNonce(server_url, *split(old_nonce2))
         # The recent nonce wasn't cleaned, so it should still fail.
-        assert not store.useNonce(server_url, *split(recent_nonce))
+        with store.batch():
+            used = [store.useNonce(server_url, *n)
+                    for n in [old_nonce1, old_nonce2, recent_nonce]]
+        assert [u.value for u in used] == [True, True, False]
     finally:
         nonceModule.SKEW = orig_skew
 
-def test_redisstore():
-    import redis
+# The tests run against their own logical database, emptied with FLUSHDB
+# after each of them, so it must not hold anything worth keeping
+TEST_DB = int(os.environ.get('OPENID_REDIS_TEST_DB', 15))
+
+@pytest.fixture(scope='session')
+def pool():
+    # One pool for the whole run, so its connection is only set up once
+    pool = redis.ConnectionPool(db=TEST_DB, max_connections=4)
+    yield pool
+    pool.disconnect()
+
+@pytest.fixture(scope='module')
+def conn(pool):
+    return redis.Redis(connection_pool=pool)
+
+@pytest.fixture(params=['default', 'pool', 'conn', 'blake2b',
+                        'decode_responses'])
+def store(request, conn, pool):
+    from openidredis import RedisStore
+
+    decoding = None
+    if request.param == 'default':
+        # Don't pass a redis connection instance, leaving it up to
+        # openid-redis to create one.
+        store = RedisStore(key_prefix='oid_redis_test', db=TEST_DB)
+    elif request.param == 'pool':
+        # Pass optional redis connection pool.
+        store = RedisStore(key_prefix='oid_redis_test', connection_pool=pool)
+    elif request.param == 'conn':
+        # Pass optional redis connection instance.
+        store = RedisStore(key_prefix='oid_redis_test', conn=conn)
+    elif request.param == 'blake2b':
+        # Derive the keys with BLAKE2b instead of SHA1.
+        store = RedisStore(key_prefix='oid_redis_test', conn=conn,
+                           hash_algo='blake2b')
+    else:
+        # Pass a redis connection that replies with str rather than bytes.
+        decoding = redis.Redis(db=TEST_DB, decode_responses=True)
+        store = RedisStore(key_prefix='oid_redis_test', conn=decoding)
+    yield store
+    conn.flushdb()
+    if decoding is not None:
+        decoding.close()
+
+@pytest.fixture
+def redis_store(conn):
+    # A plain store on conn, for the tests of single APIs
     from openidredis import RedisStore
 
-    conn = redis.Redis()
+    yield RedisStore(key_prefix='oid_redis_test', conn=conn)
+    conn.flushdb()
+
+SERVER_URL = 'http://www.myopenid.com/openid'
+
+def test_redisstore(store):
+    _store_check(store)
+
+def test_unknown_hash_algo(conn):
+    from openidredis import RedisStore
 
-    def clear_keys():
-        # Clear out old keys
-        for key in conn.keys('oid_redis_test*'):
-            conn.delete(key)
+    with pytest.raises(ValueError):
+        RedisStore(key_prefix='oid_redis_test', conn=conn, hash_algo='md5')
+
+def test_redisstore_batch(redis_store, conn):
+    store = redis_store
+    server_url = SERVER_URL
+    assoc = _gen_assoc(int(time.time()), 0)
+    stamp, salt = split(mkNonce())
+
+    with store.batch():
+        stored = store.storeAssociation(server_url, assoc)
+        by_handle = store.getAssociation(server_url, assoc.handle)
+        latest = store.getAssociation(server_url)
+        both = store.getAssociations(server_url, [None, assoc.handle])
+        used = store.useNonce(server_url, stamp, salt)
+        reused = store.useNonce(server_url, stamp, salt)
+        stale = store.useNonce(server_url, 3600, salt)
+
+        # Nothing has been sent to Redis yet
+        assert conn.get(store.getAssociationFilename(server_url,
+                                                     assoc.handle)) is None
+        with pytest.raises(RuntimeError):
+            by_handle.value
+
+    assert stored.value is None
+    assert by_handle.value == assoc
+    assert latest.value == assoc
+    assert both.value == {None: assoc, assoc.handle: assoc}
+    assert used.value is True
+    assert reused.value is False
+    assert stale.value is False
+
+    with store.batch():
+        removed = store.removeAssociation(server_url, assoc.handle)
+        missing = store.getAssociation(server_url)
+    assert removed.value
+    assert missing.value is None
+
+def test_nested_batch(redis_store):
+    store = redis_store
+    assoc = _gen_assoc(int(time.time()), 0)
+
+    with store.batch():
+        stored = store.storeAssociation(SERVER_URL, assoc)
+        with store.batch():
+            latest = store.getAssociation(SERVER_URL)
+        # The inner batch joined the outer one, nothing was sent yet
+        with pytest.raises(RuntimeError):
+            latest.value
+    assert stored.value is None
+    assert latest.value == assoc
+
+def test_failed_batch():
+    from openidredis import RedisStore
 
-    # Don't pass a redis connection instance, leaving it up to openid-redis to
-    # create one.
+    # Nothing listens on port 1, so sending the batch fails
+    store = RedisStore(key_prefix='oid_redis_test', port=1)
+    with pytest.raises(redis.ConnectionError):
+        with store.batch():
+            latest = store.getAssociation(SERVER_URL)
+    with pytest.raises(redis.ConnectionError):
+        latest.value
+
+def test_index_script_loaded(redis_store, conn):
+    store = redis_store
+    assoc = _gen_assoc(int(time.time()), 0)
+    store.storeAssociation(SERVER_URL, assoc)
+    _check_retrieve(store, SERVER_URL, None, assoc)
+
+    # The script is sent by its digest, and loaded again when Redis lost it
+    conn.script_flush()
+    _check_retrieve(store, SERVER_URL, None, assoc)
+    with store.batch():
+        latest = store.getAssociation(SERVER_URL)
+    assert latest.value == assoc
+
+def test_cleanup_associations(redis_store, conn):
+    store = redis_store
+    now = int(time.time())
+    assocs = [_gen_assoc(now, issued) for issued in range(3)]
+
+    store.storeAssociations([(SERVER_URL, assoc) for assoc in assocs])
+    assert store.cleanupAssociations() == 0
+
+    # Have the two latest associations expire the way Redis would
+    conn.delete(*[store.getAssociationFilename(SERVER_URL, assoc.handle)
+                  for assoc in assocs[1:]])
+    # One entry per SSCAN step, so the index takes several of them
+    assert store.cleanupAssociations(count=1) == 2
+    # Their index entries are gone, so there is nothing left to prune
+    assert store.cleanupAssociations() == 0
+    _check_retrieve(store, SERVER_URL, None, assocs[0])
+
+    conn.delete(store.getAssociationFilename(SERVER_URL, assocs[0].handle))
+    assert store.cleanupAssociations() == 1
+    assert store.cleanupAssociations() == 0
+    assert store.getAssociation(SERVER_URL) is None
+
+@pytest.mark.parametrize('decode_responses', [False, True])
+def test_reindex_associations(redis_store, conn, decode_responses):
+    from openidredis import RedisStore
+
+    store = redis_store
+    now = int(time.time())
+    assoc, assoc2 = _gen_assoc(now, 0), _gen_assoc(now, 1)
+    # Written the way versions before the index SETs did, next to one of
+    # their nonces
+    for association in [assoc, assoc2]:
+        conn.set(store.getAssociationFilename(SERVER_URL, association.handle),
+                 association.serialize(), ex=600)
+    conn.set(b'oid_redis_test-nonce-00000000-http-www.myopenid.com-x-y', '0',
+             ex=600)
+    # Keys of a store whose key_prefix starts with this one's, which the
+    # reindex leaves alone
+    staging = RedisStore(key_prefix='oid_redis_test-staging', conn=conn)
+    conn.set(staging.getAssociationFilename(SERVER_URL, assoc.handle),
+             assoc.serialize(), ex=600)
+    conn.set(b'oid_redis_test-staging-nonce-00000000-http-www.myopenid.com-'
+             b'x-y', '0', ex=600)
+    assert store.getAssociation(SERVER_URL) is None
+
+    # One key per SCAN step, so the pipeline is sent more than once. A
+    # client that decodes responses SCANs the keys as str.
+    client = redis.Redis(db=TEST_DB, decode_responses=decode_responses)
+    try:
+        reindexing = RedisStore(key_prefix='oid_redis_test', conn=client)
+        assert reindexing.reindexAssociations(count=1) == 2
+        assert reindexing.reindexAssociations() == 0
+    finally:
+        client.close()
+    _check_retrieve(store, SERVER_URL, None, assoc2)
+    _check_retrieve(store, SERVER_URL, assoc.handle, assoc)
+    # Only this store's index was created
+    assert len(conn.keys('*:idx')) == 1
+    assert staging.getAssociation(SERVER_URL) is None
+
+def test_legacy_nonce(redis_store, conn):
+    store = redis_store
+    stamp, salt = split(mkNonce())
+    # The key versions before the nonce ZSET stored this nonce under, its
+    # proto-domain-url_hash-salt_hash tail is shaped like an association key
+    tail = store.getAssociationFilename(SERVER_URL, salt).split(b'-', 1)[1]
+    legacy_key = b'oid_redis_test-nonce-%08x-%s' % (stamp, tail)
+    conn.set(legacy_key, stamp, ex=600)
+
+    assert store.useNonce(SERVER_URL, stamp, salt) is False
+
+@pytest.mark.parametrize('store_class', ['RedisStore', 'AsyncRedisStore'])
+def test_unix_socket(store_class):
+    import openidredis
+
+    # Connections are only made on first use, so no server is needed
+    store = getattr(openidredis, store_class)(key_prefix='oid_redis_test',
+                                              unix_socket='/tmp/redis.sock',
+                                              db=TEST_DB)
+    connection_kwargs = store._conn.connection_pool.connection_kwargs
+    assert connection_kwargs['path'] == '/tmp/redis.sock'
+    assert connection_kwargs['db'] == TEST_DB
+    assert store.unix_socket == '/tmp/redis.sock'
+
+    # A connection passed in is read back the same way
+    store = getattr(openidredis, store_class)(key_prefix='oid_redis_test',
+                                              conn=store._conn)
+    assert store.unix_socket == '/tmp/redis.sock'
+    assert (store.host, store.port, store.db) == (None, 0, TEST_DB)
+
+class _Gathered(object):
+    value = None
+
+class _AwaitingStore(object):
+    """Run each call of an AsyncRedisStore to completion on one event loop,
+    so the synchronous store check can drive it. Calls made in a batch are
+    run together with asyncio.gather when it ends instead."""
+    def __init__(self, store, loop):
+        self._store = store
+        self._loop = loop
+        self._gathering = None
+
+    def __getattr__(self, name):
+        method = getattr(self._store, name)
+        def call(*args, **kwargs):
+            if self._gathering is None:
+                return self._loop.run_until_complete(method(*args, **kwargs))
+            result = _Gathered()
+            self._gathering.append((method(*args, **kwargs), result))
+            return result
+        return call
+
+    @contextlib.contextmanager
+    def batch(self):
+        self._gathering = gathering = []
+        try:
+            yield
+        except BaseException:
+            for coro, _ in gathering:
+                coro.close()
+            raise
+        finally:
+            self._gathering = None
+
+        async def gather():
+            return await asyncio.gather(*[coro for coro, _ in gathering])
+        values = self._loop.run_until_complete(gather())
+        for (_, result), value in zip(gathering, values):
+            result.value = value
+
+def test_async_redisstore(conn):
+    from openidredis import AsyncRedisStore
+
+    loop = asyncio.new_event_loop()
+    store = AsyncRedisStore(key_prefix='oid_redis_test', db=TEST_DB)
     try:
-        _store_check(RedisStore(key_prefix='oid_redis_test'))
+        _store_check(_AwaitingStore(store, loop))
     finally:
-        clear_keys()
+        loop.run_until_complete(store._conn.connection_pool.disconnect())
+        loop.close()
+        conn.flushdb()
+
+def test_async_cleanup(conn):
+    from openidredis import AsyncRedisStore
+
+    loop = asyncio.new_event_loop()
+    store = AsyncRedisStore(key_prefix='oid_redis_test', db=TEST_DB)
+    now = int(time.time())
+    assoc = _gen_assoc(now, 0)
+    old_nonce = split(mkNonce(now - 20000))
+
+    async def check():
+        await store.storeAssociation(SERVER_URL, assoc)
+        # Have the association expire the way Redis would
+        conn.delete(store.getAssociationFilename(SERVER_URL, assoc.handle))
+        orig_skew = nonceModule.SKEW
+        try:
+            # Set SKEW high so the store keeps the old nonce.
+            nonceModule.SKEW = 100000
+            assert await store.useNonce(SERVER_URL, *old_nonce)
+        finally:
+            nonceModule.SKEW = orig_skew
+        return await store.cleanup()
 
-    # Pass optional redis connection instance.
     try:
-        _store_check(RedisStore(key_prefix='oid_redis_test', conn=conn))
+        assert loop.run_until_complete(check()) == (1, 1)
     finally:
-        clear_keys()
+        loop.run_until_complete(store._conn.connection_pool.disconnect())
+        loop.close()
+        conn.flushdb()